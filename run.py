@@ -1,72 +1,204 @@
+import asyncio
+import json
+import os
+import shutil
+import signal
 import subprocess
-import threading
 import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# Descriptors opened by Python are non-inheritable already, so on POSIX the close_fds sweep is
+# redundant and each child can skip closing every descriptor it was handed.
+CLOSE_FDS = sys.platform.startswith('win')
+
+# On POSIX every command leads its own session, so stopping it reaches the shell, npm and
+# anything else they started instead of only the process we spawned.
+NEW_SESSION = not sys.platform.startswith('win')
+
+# Children started by run_command that have not been stopped yet.
+RUNNING = set()
 
 def install_dependencies():
     """ Install necessary dependencies Rust and Node.js if needed. """
     if sys.platform.startswith('win'):
-        if not command_available("cargo --version"):
-            print("Installing Rust via winget...")
-            subprocess.run("winget install --id=Rustlang.Rustup -e --silent", shell=True, check=True)
-        if not command_available("node --version"):
-            print("Installing Node.js via winget...")
-            subprocess.run("winget install --id=OpenJS.NodeJS -e --silent", shell=True, check=True)
+        installers = {
+            "cargo": ("Installing Rust via winget...", ["winget install --id=Rustlang.Rustup -e --silent"]),
+            "node": ("Installing Node.js via winget...", ["winget install --id=OpenJS.NodeJS -e --silent"]),
+        }
+    else:
+        installers = {
+            "cargo": ("Installing Rust...", ["curl https://sh.rustup.rs -sSf | sh -s -- -y"]),
+            "node": ("Installing Node.js...", [
+                "curl -o- https://raw.githubusercontent.com/nvm-sh/nvm/v0.39.1/install.sh | bash",
+                "export NVM_DIR=\"$HOME/.nvm\" && [ -s \"$NVM_DIR/nvm.sh\" ] && \\. \"$NVM_DIR/nvm.sh\"; nvm install node && nvm use node",
+            ]),
+        }
+
+    missing = [installer for executable, installer in installers.items() if not command_available(executable)]
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(lambda installer: run_installer(*installer), missing))
+
+def run_installer(message, commands):
+    """ Run the shell commands installing a single dependency in order. """
+    print(message)
+    for command in commands:
+        subprocess.run(command, shell=True, check=True)
+
+def command_available(executable):
+    """ Check if the executable is available on the system. """
+    return shutil.which(executable) is not None
+
+def write_output(lines, head):
+    """ Write a batch of raw lines, each preceded by head, to stdout with a single write. """
+    sys.stdout.flush()
+    sys.stdout.buffer.write(head + (b'\n' + head).join(lines) + b'\n')
+    sys.stdout.buffer.flush()
+
+async def pump_output(stream, prefix):
+    """ Read a child pipe in large chunks and print each complete line with a prefix. """
+    head = f"{prefix}: ".encode()
+    buffer = bytearray()
+    while chunk := await stream.read(65536):
+        buffer += chunk
+        end = buffer.rfind(b'\n')
+        if end >= 0:
+            write_output(buffer[:end].split(b'\n'), head)
+            del buffer[:end + 1]
+    if buffer:
+        write_output([buffer], head)
+
+def signal_process(process, kill=False):
+    """ Terminate or kill a child together with every process it started. """
+    if NEW_SESSION:
+        try:
+            os.killpg(process.pid, signal.SIGKILL if kill else signal.SIGTERM)
+        except ProcessLookupError:
+            pass
     else:
-        if not command_available("cargo --version"):
-            print("Installing Rust...")
-            subprocess.run("curl https://sh.rustup.rs -sSf | sh -s -- -y", shell=True, check=True)
-        if not command_available("node --version"):
-            print("Installing Node.js...")
-            subprocess.run("curl -o- https://raw.githubusercontent.com/nvm-sh/nvm/v0.39.1/install.sh | bash", shell=True, check=True)
-            subprocess.run("export NVM_DIR=\"$HOME/.nvm\" && [ -s \"$NVM_DIR/nvm.sh\" ] && \\. \"$NVM_DIR/nvm.sh\"; nvm install node && nvm use node", shell=True, check=True)
-
-def command_available(command):
-    """ Check if the command is available on the system. """
+        # taskkill walks the tree from the root, so the root must still be alive for both steps.
+        force = ["/F"] if kill else []
+        subprocess.run(["taskkill", *force, "/T", "/PID", str(process.pid)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+async def finish_process(process):
+    """ Wait for a child to exit, discarding whatever is left in its pipes. """
+    await asyncio.gather(process.stdout.read(), process.stderr.read(), process.wait())
+
+async def stop_process(process, timeout=10):
+    """ Terminate a child process tree, killing it if it has not exited within the timeout. """
+    signal_process(process)
     try:
-        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
-        return True
-    except subprocess.CalledProcessError:
-        return False
+        await asyncio.wait_for(finish_process(process), timeout)
+    except asyncio.TimeoutError:
+        signal_process(process, kill=True)
+        try:
+            await asyncio.wait_for(finish_process(process), timeout)
+        except asyncio.TimeoutError:
+            pass
 
-def run_command(command, prefix):
-    """ Helper function to run a command in the shell and print the output. """
+async def run_command(command, prefix, read_stdout=None):
+    """ Run a shell command string or an argument list and print the output. """
+    options = dict(stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=CLOSE_FDS, start_new_session=NEW_SESSION)
+    process = None
+    readers = []
     try:
-        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-        for line in process.stdout:
-            print(f"{prefix}: {line}", end='')
-        process.stdout.close()
-        return_code = process.wait()
+        if isinstance(command, str):
+            process = await asyncio.create_subprocess_shell(command, **options)
+        else:
+            process = await asyncio.create_subprocess_exec(*command, **options)
+        RUNNING.add(process)
+        stdout = read_stdout(process.stdout) if read_stdout else pump_output(process.stdout, prefix)
+        readers = [asyncio.ensure_future(stdout), asyncio.ensure_future(pump_output(process.stderr, prefix))]
+        await asyncio.gather(*readers)
+        return_code = await process.wait()
         if return_code:
             raise subprocess.CalledProcessError(return_code, command)
+        return True
     except Exception as e:
             print(f"{prefix} Error: An unexpected error occurred while executing {command}: {e}")
+            return False
+    finally:
+        # Whatever ended the command, release its pipes and never leave the process tree running.
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+        if process is not None and process.returncode is None:
+            await stop_process(process)
+        RUNNING.discard(process)
 
-def run_in_thread(command, prefix):
-    """ Run commands in a separate thread. """
-    thread = threading.Thread(target=run_command, args=(command, prefix))
-    thread.start()
-    return thread
+def handle_shutdown_signals(task, signals):
+    """ Cancel task on the first signal, then kill every running process tree on any repeat. """
+    stopping = False
 
-def main():
-    user_input = input("Do you want to run the mock service? (Press Enter or 'y/yes' for yes; any other key for no): ").strip().lower()
-    use_mock = user_input == '' or user_input in ['y', 'yes']
+    def shutdown():
+        nonlocal stopping
+        if stopping:
+            for process in list(RUNNING):
+                signal_process(process, kill=True)
+        else:
+            stopping = True
+            task.cancel()
 
-    install_dependencies()
+    for sig in signals:
+        asyncio.get_running_loop().add_signal_handler(sig, shutdown)
+
+async def read_executables(stream, executables):
+    """ Collect the path of every binary reported in cargo's JSON build messages. """
+    for line in (await stream.read()).splitlines():
+        message = json.loads(line)
+        if message.get("reason") == "compiler-artifact" and message.get("executable"):
+            executables[message["target"]["name"]] = message["executable"]
+
+async def run_services(use_mock):
+    """ Run the setup steps, then all services concurrently from a single event loop. """
+    if not sys.platform.startswith('win'):
+        # Children run in their own sessions, so terminal signals only reach them through here.
+        handle_shutdown_signals(asyncio.current_task(), [signal.SIGINT, signal.SIGTERM, signal.SIGHUP])
 
-    run_command("npm install", "\033[0;31m[Npm]\033[0;0m")
+    cargo = shutil.which("cargo") or "cargo"
+    binaries = {"server": "lumisync-server"}
+    if use_mock:
+        binaries["mock"] = "lumisync-mock"
+
+    build = [cargo, "build", "--message-format=json-render-diagnostics"]
+    for binary, package in binaries.items():
+        build += ["--package", package, "--bin", binary]
 
-    run_command("cargo install sqlx-cli", "\033[0;31m[Cargo]\033[0;0m")
+    executables = {}
+    # return_exceptions keeps gather waiting for every command to finish its cleanup on cancellation.
+    results = await asyncio.gather(
+        run_command("npm install", "\033[0;31m[Npm]\033[0;0m"),
+        run_command([cargo, "install", "sqlx-cli"], "\033[0;31m[Cargo]\033[0;0m"),
+        run_command(build, "\033[0;31m[Cargo]\033[0;0m", lambda stream: read_executables(stream, executables)),
+        return_exceptions=True,
+    )
+    if results[-1] is not True:
+        return
 
-    threads = []
+    missing = [binary for binary in binaries if binary not in executables]
+    if missing:
+        print(f"\033[0;31m[Cargo]\033[0;0m Error: The build did not report an executable for {', '.join(missing)}")
+        return
+
+    services = []
 
     if use_mock:
-        threads.append(run_in_thread("cargo run --package lumisync-mock --bin mock", "\033[0;33m[Mock]\033[0;0m"))
+        services.append(run_command([executables["mock"]], "\033[0;33m[Mock]\033[0;0m"))
+
+    services.append(run_command([executables["server"]], "\033[0;34m[Server]\033[0;0m"))
+    services.append(run_command("npm run web", "\033[0;32m[Web]\033[0;0m"))
 
-    threads.append(run_in_thread("cargo run --package lumisync-server --bin server", "\033[0;34m[Server]\033[0;0m"))
-    threads.append(run_in_thread("npm run web", "\033[0;32m[Web]\033[0;0m"))
+    await asyncio.gather(*services, return_exceptions=True)
 
-    for thread in threads:
-        thread.join()
+def main():
+    user_input = input("Do you want to run the mock service? (Press Enter or 'y/yes' for yes; any other key for no): ").strip().lower()
+    use_mock = user_input == '' or user_input in ['y', 'yes']
+
+    install_dependencies()
+
+    try:
+        asyncio.run(run_services(use_mock))
+    except (asyncio.CancelledError, KeyboardInterrupt):
+        pass
 
 if __name__ == "__main__":
     main()
\ No newline at end of file